@@ -6,17 +6,20 @@
 # All Rights Reserved
 
 import argparse
-import ctypes
 import logging
 import multiprocessing
 import os
-import subprocess
 import sys
 
+# thread pools of BLAS libraries are created when numpy is imported, so the limit must be set before,
+# parallelism comes from the jobs of multiprocessing pool
+for var in ('MKL_NUM_THREADS', 'OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+    os.environ.setdefault(var, '1')
+
 import numpy as np
 
 from vbdiar.embeddings.embedding import extract_embeddings
-from vbdiar.features.segments import get_segments, get_time_from_frames, get_frames_from_time
+from vbdiar.features.segments import get_segments_array, get_times_from_frames, get_frames_from_times
 from vbdiar.kaldi.mfcc_features_extraction import KaldiMFCCFeatureExtraction
 from vbdiar.kaldi.onnx_xvector_extraction import ONNXXVectorExtraction
 from vbdiar.kaldi.python_mfcc_features_extraction import PythonMFCCFeatureExtraction
@@ -33,20 +36,30 @@ logger = logging.getLogger(__name__)
 CDIR = os.path.dirname(os.path.realpath(__file__))
 
 
-def _process_files(dargs):
+# arguments of process_file shared by all files, set once per worker of multiprocessing pool
+_worker_kwargs = None
+
+
+def _init_worker(kwargs):
+    """ Initialize worker of multiprocessing pool.
+
+    Args:
+        kwargs (dict): arguments of process_file shared by all files
     """
+    global _worker_kwargs
+    _worker_kwargs = kwargs
+
+
+def _process_file_worker(fn):
+    """ Process single file in worker of multiprocessing pool.
 
     Args:
-        dargs:
+        fn (str): name of file to process
 
     Returns:
-
+        EmbeddingSet
     """
-    fns, kwargs = dargs
-    ret = []
-    for fn in fns:
-        ret.append(process_file(file_name=fn, **kwargs))
-    return ret
+    return process_file(file_name=fn, **_worker_kwargs)
 
 
 def process_files(fns, wav_dir, vad_dir, out_dir, features_extractor, embedding_extractor, min_size,
@@ -71,15 +84,18 @@ def process_files(fns, wav_dir, vad_dir, out_dir, features_extractor, embedding_
     Returns:
         List[EmbeddingSet]
     """
+    wav_dir, vad_dir = os.path.abspath(wav_dir), os.path.abspath(vad_dir)
+    if out_dir:
+        out_dir = os.path.abspath(out_dir)
     kwargs = dict(wav_dir=wav_dir, vad_dir=vad_dir, out_dir=out_dir, features_extractor=features_extractor,
                   embedding_extractor=embedding_extractor, tolerance=tolerance, min_size=min_size,
                   max_size=max_size, overlap=overlap, wav_suffix=wav_suffix, vad_suffix=vad_suffix)
     if n_jobs == 1:
-        ret = _process_files((fns, kwargs))
-    else:
-        pool = multiprocessing.Pool(n_jobs)
-        ret = pool.map(_process_files, ((part, kwargs) for part in Utils.partition(fns, n_jobs)))
-    return [item for sublist in ret for item in sublist]
+        return [process_file(file_name=fn, **kwargs) for fn in fns]
+    # files are handed out in small chunks, so workers processing short files do not wait for the long ones,
+    # extractors are inherited by forked workers, since ONNX Runtime session can not be pickled
+    with multiprocessing.get_context('fork').Pool(n_jobs, initializer=_init_worker, initargs=(kwargs,)) as pool:
+        return list(pool.imap(_process_file_worker, fns, chunksize=max(1, len(fns) // (4 * n_jobs))))
 
 
 def process_file(wav_dir, vad_dir, out_dir, file_name, features_extractor, embedding_extractor,
@@ -108,27 +124,26 @@ def process_file(wav_dir, vad_dir, out_dir, file_name, features_extractor, embed
     if len(file_name.split()) > 1:  # number of speakers is defined
         file_name, num_speakers = file_name.split()[0], int(file_name.split()[1])
 
-    wav_dir, vad_dir = os.path.abspath(wav_dir), os.path.abspath(vad_dir)
-    if out_dir:
-        out_dir = os.path.abspath(out_dir)
-
     # extract features
     features = features_extractor.audio2features(os.path.join(wav_dir, f'{file_name}{wav_suffix}'))
+    assert features.dtype == np.float32 and features.flags.c_contiguous, \
+        f'Expected C-contiguous float32 features, got {features.dtype}.'
 
     # load voice activity detection from file
     vad, _, _ = get_vad(f'{os.path.join(vad_dir, file_name)}{vad_suffix}', features.shape[0])
 
     # parse segments and split features
-    features_dict = {}
-    for seg in get_segments(vad, max_size, tolerance):
-        seg_start, seg_end = seg
-        start, end = get_time_from_frames(seg_start), get_time_from_frames(seg_end)
-        if start >= overlap:
-            seg_start = get_frames_from_time(start - overlap)
-        if seg_start > features.shape[0] - 1 or seg_end > features.shape[0] - 1:
-            logger.warning(f'Frames not aligned, number of frames {features.shape[0]} and got ending segment {seg_end}')
-            seg_end = features.shape[0]
-        features_dict[(start, end)] = features[seg_start:seg_end]
+    segments = get_segments_array(vad, max_size, tolerance)
+    starts, ends = get_times_from_frames(segments[:, 0]), get_times_from_frames(segments[:, 1])
+    seg_starts = np.where(starts >= overlap, get_frames_from_times(np.maximum(starts - overlap, 0)), segments[:, 0])
+    seg_ends = segments[:, 1]
+    misaligned = (seg_starts > features.shape[0] - 1) | (seg_ends > features.shape[0] - 1)
+    if np.any(misaligned):
+        logger.warning(f'Frames not aligned, number of frames {features.shape[0]} and got {np.sum(misaligned)} '
+                       f'segments ending up to frame {np.max(seg_ends[misaligned])}')
+        seg_ends = np.where(misaligned, features.shape[0], seg_ends)
+    features_dict = {(start, end): features[seg_start:seg_end] for start, end, seg_start, seg_end in zip(
+        starts.tolist(), ends.tolist(), seg_starts.tolist(), seg_ends.tolist())}
 
     # extract embedding for each segment
     embedding_set = extract_embeddings(features_dict, embedding_extractor)
@@ -137,37 +152,38 @@ def process_file(wav_dir, vad_dir, out_dir, file_name, features_extractor, embed
 
     # save embeddings if required
     if out_dir is not None:
-        mkdir_p(os.path.join(out_dir, os.path.dirname(file_name)))
-        embedding_set.save(os.path.join(out_dir, '{}.pkl'.format(file_name)))
+        embedding_set.save(os.path.join(out_dir, file_name))
 
     return embedding_set
 
 
-def set_mkl(num_cores=1):
-    """ Set number of cores for mkl library.
+def get_gpu(really=True):
+    """ Make visible only the first GPU with almost all memory free.
 
     Args:
-        num_cores (int): number of cores
+        really (bool): use GPU, otherwise all GPUs are hidden
     """
-    try:
-        mkl_rt = ctypes.CDLL('libmkl_rt.so')
-        mkl_rt.mkl_set_dynamic(ctypes.byref(ctypes.c_int(0)))
-        mkl_rt.mkl_set_num_threads(ctypes.byref(ctypes.c_int(num_cores)))
-    except OSError:
-        logger.warning('Failed to import libmkl_rt.so, it will not be possible to use mkl backend.')
-
-
-def get_gpu(really=True):
-    try:
-        if really:
-            command = 'nvidia-smi --query-gpu=memory.free,memory.total --format=csv |tail -n+2| ' \
-                      'awk \'BEGIN{FS=" "}{if ($1/$3 > 0.98) print NR-1}\''
-            gpu_idx = subprocess.check_output(command, shell=True).rsplit(b'\n')[0].decode('utf-8')
-        else:
-            gpu_idx = '-1'
-        os.environ["CUDA_VISIBLE_DEVICES"] = gpu_idx
-    except subprocess.CalledProcessError:
-        logger.warning('No GPUs seems to be available.')
+    gpu_idx = '-1'
+    if really:
+        try:
+            import pynvml
+        except ImportError:
+            pynvml = None
+            logger.warning('Failed to import pynvml, it will not be possible to use GPU.')
+        if pynvml is not None:
+            try:
+                pynvml.nvmlInit()
+                try:
+                    for ii in range(pynvml.nvmlDeviceGetCount()):
+                        memory_info = pynvml.nvmlDeviceGetMemoryInfo(pynvml.nvmlDeviceGetHandleByIndex(ii))
+                        if memory_info.free / memory_info.total > 0.98:
+                            gpu_idx = str(ii)
+                            break
+                finally:
+                    pynvml.nvmlShutdown()
+            except pynvml.NVMLError:
+                logger.warning('No GPUs seems to be available.')
+    os.environ["CUDA_VISIBLE_DEVICES"] = gpu_idx
 
 
 if __name__ == '__main__':
@@ -215,15 +231,18 @@ if __name__ == '__main__':
     parser.add_argument('--vad-tolerance', default=0,
                         help='tolerance critetion for ignoring frames of silence', type=float, required=False)
     parser.add_argument('--use-gpu', required=False, default=False, action='store_true',
-                        help='use GPU instead of cpu (onnxruntime-gpu must be installed)')
+                        help='use GPU instead of cpu (onnxruntime-gpu and pynvml must be installed)')
     parser.add_argument('--max-num-speakers',
                         help='maximal number of speakers', required=False, default=10)
+    parser.add_argument('--n-jobs', default=1,
+                        help='number of files processed in parallel', type=int, required=False)
+    parser.add_argument('--features-cache-dir', required=False,
+                        help='directory for caching extracted features, reused by subsequent runs on the same audio')
 
     args = parser.parse_args()
 
     logger.info(f'Running `{" ".join(sys.argv)}`.')
 
-    set_mkl(1)
     get_gpu(args.use_gpu)
 
     # initialize extractor
@@ -236,10 +255,13 @@ if __name__ == '__main__':
     # features_extractor = KaldiMFCCFeatureExtraction(
     #     config_path=config_path, apply_cmvn_sliding=config_mfcc['apply_cmvn_sliding'],
     #     norm_vars=config_mfcc['norm_vars'], center=config_mfcc['center'], cmn_window=config_mfcc['cmn_window'])
-    features_extractor = PythonMFCCFeatureExtraction()
+    features_extractor = PythonMFCCFeatureExtraction(cache_dir=args.features_cache_dir)
 
     config_embedding_extractor = config['EmbeddingExtractor']
-    embedding_extractor = ONNXXVectorExtraction(onnx_path=os.path.abspath(config_embedding_extractor['onnx_path']))
+    # cores are divided among the jobs, single job uses default of ONNX Runtime
+    embedding_extractor = ONNXXVectorExtraction(
+        onnx_path=os.path.abspath(config_embedding_extractor['onnx_path']),
+        num_threads=None if args.n_jobs == 1 else max(1, os.cpu_count() // args.n_jobs))
 
     config_transforms = config['Transforms']
     mean = config_transforms.get('mean')
@@ -251,7 +273,8 @@ if __name__ == '__main__':
     if plda is not None:
         plda = GPLDA(plda['path'])
 
-    files = [line.rstrip('\n') for line in open(args.input_list)]
+    with open(args.input_list) as f:
+        files = f.read().splitlines()
 
     # extract embeddings
     if args.in_emb_dir is None:
@@ -266,7 +289,7 @@ if __name__ == '__main__':
             features_extractor=features_extractor, embedding_extractor=embedding_extractor,
             min_size=args.min_window_size, max_size=args.max_window_size, overlap=args.window_overlap,
             tolerance=args.vad_tolerance, wav_suffix=args.wav_suffix, vad_suffix=args.vad_suffix,
-            n_jobs=1)
+            n_jobs=args.n_jobs)
         if args.out_emb_dir:
             embeddings = args.out_emb_dir
     else:
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 Brno University of Technology FIT
+# Author: Jan Profant <jan.profant@phonexia.com>
+# All Rights Reserved
+
+import argparse
+import collections
+import logging
+import sys
+
+import onnx
+
+from vbdiar.kaldi.onnx_xvector_extraction import get_optimized_path, optimize_onnx
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def count_ops(model):
+    """ Count nodes of neural net by operator type.
+
+    Args:
+        model (onnx.ModelProto): neural net
+
+    Returns:
+        collections.Counter: number of nodes for each operator type
+    """
+    return collections.Counter(node.op_type for node in model.graph.node)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Store x-vector extractor with graph optimizations already applied.')
+
+    parser.add_argument('in_onnx_path', help='input nnet in ONNX format')
+    parser.add_argument('--out-onnx-path', required=False,
+                        help='output path of optimized nnet, defaults to `<name>.opt.onnx` next to the input nnet, '
+                             'which is loaded automatically by ONNXXVectorExtraction')
+
+    args = parser.parse_args()
+
+    logger.info(f'Running `{" ".join(sys.argv)}`.')
+
+    out_onnx_path = args.out_onnx_path or get_optimized_path(args.in_onnx_path)
+    optimize_onnx(args.in_onnx_path, out_onnx_path)
+    before, after = count_ops(onnx.load(args.in_onnx_path)), count_ops(onnx.load(out_onnx_path))
+    logger.info(f'Number of nodes reduced from {sum(before.values())} to {sum(after.values())}, '
+                f'operators: {dict(after)}.')
+    logger.info(f'Optimized nnet stored in `{out_onnx_path}`.')
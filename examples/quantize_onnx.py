@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 Brno University of Technology FIT
+# Author: Jan Profant <jan.profant@phonexia.com>
+# All Rights Reserved
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+
+import numpy as np
+import onnx
+import onnxruntime
+from onnx import version_converter
+from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+from onnxruntime.quantization.shape_inference import quant_pre_process
+
+from vbdiar.features.segments import get_segments
+from vbdiar.kaldi.onnx_xvector_extraction import (MIN_SIGNAL_LEN, get_file_hash, get_quantized_path, load_onnx,
+                                                  set_source_hash)
+from vbdiar.kaldi.python_mfcc_features_extraction import PythonMFCCFeatureExtraction
+from vbdiar.utils import atomic_path
+from vbdiar.utils.utils import Utils
+from vbdiar.vad import get_vad
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# per-channel QDQ quantization requires DequantizeLinear with `axis` attribute
+QDQ_OPSET = 13
+
+
+class SegmentsCalibrationDataReader(CalibrationDataReader):
+    """ Feed MFCC features of speech segments to the static quantization calibration. """
+
+    def __init__(self, input_name, segments):
+        """ Initialize calibration data reader.
+
+        Args:
+            input_name (str): name of the input of the neural net
+            segments (List[np.array]): features of the segments
+        """
+        self.input_name = input_name
+        self.segments = iter(segments)
+
+    def get_next(self):
+        segment = next(self.segments, None)
+        if segment is None:
+            return None
+        return {self.input_name: np.ascontiguousarray(segment.T[np.newaxis, :, :], dtype=np.float32)}
+
+
+def load_segments(fns, wav_dir, vad_dir, features_extractor, max_size, tolerance, num_segments,
+                  wav_suffix='.wav', vad_suffix='.lab.gz'):
+    """ Extract features of speech segments in the same way as diarization does.
+
+    Args:
+        fns (list): name of files to process
+        wav_dir (str): directory with wav files
+        vad_dir (str): directory with vad files
+        features_extractor (Any): intialized object for feature extraction
+        max_size (int): maximal size of window in ms
+        tolerance (int): accept given number of frames as speech even when it is marked as silence
+        num_segments (int): maximal number of segments to load
+        wav_suffix (str): suffix of wav files
+        vad_suffix (str): suffix of vad files
+
+    Returns:
+        List[np.array]: features of the segments
+    """
+    segments = []
+    for file_name in fns:
+        file_name = file_name.split()[0]
+        features = features_extractor.audio2features(os.path.join(wav_dir, f'{file_name}{wav_suffix}'))
+        vad, _, _ = get_vad(f'{os.path.join(vad_dir, file_name)}{vad_suffix}', features.shape[0])
+        for seg_start, seg_end in get_segments(vad, max_size, tolerance):
+            if seg_end - seg_start >= MIN_SIGNAL_LEN:
+                segments.append(features[seg_start:seg_end])
+            if len(segments) >= num_segments:
+                return segments
+    return segments
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Quantize x-vector extractor to INT8 using static calibration.')
+
+    # required
+    parser.add_argument('-l', '--input-list', help='list of calibration files without suffix',
+                        action='store', required=True)
+    parser.add_argument('-c', '--configuration', help='input configuration of models',
+                        action='store', required=True)
+    parser.add_argument('--audio-dir',
+                        help='directory with audio files in .wav format - 16000Hz, 16bit-s, 1c', required=True)
+    parser.add_argument('--vad-dir',
+                        help='directory with lab files - Voice/Speech activity detection', required=True)
+
+    # not required
+    parser.add_argument('--out-onnx-path', required=False,
+                        help='output path of quantized nnet, defaults to `<name>.int8.onnx` next to the input nnet, '
+                             'which is loaded automatically by ONNXXVectorExtraction')
+    parser.add_argument('--num-segments', default=50,
+                        help='number of speech segments used for calibration', type=int, required=False)
+    parser.add_argument('-wav-suffix',
+                        help='wav file suffix', required=False, default='.wav')
+    parser.add_argument('-vad-suffix',
+                        help='Voice Activity Detector file suffix', required=False, default='.lab.gz')
+    parser.add_argument('--max-window-size', default=2000,
+                        help='maximal window size for extracting embedding in ms', type=int, required=False)
+    parser.add_argument('--vad-tolerance', default=0,
+                        help='tolerance critetion for ignoring frames of silence', type=float, required=False)
+
+    args = parser.parse_args()
+
+    logger.info(f'Running `{" ".join(sys.argv)}`.')
+
+    config = Utils.read_config(args.configuration)
+    onnx_path = os.path.abspath(config['EmbeddingExtractor']['onnx_path'])
+    out_onnx_path = args.out_onnx_path or get_quantized_path(onnx_path)
+
+    with open(args.input_list) as f:
+        files = f.read().splitlines()
+
+    segments = load_segments(
+        fns=files, wav_dir=args.audio_dir, vad_dir=args.vad_dir, features_extractor=PythonMFCCFeatureExtraction(),
+        max_size=args.max_window_size, tolerance=args.vad_tolerance, num_segments=args.num_segments,
+        wav_suffix=args.wav_suffix, vad_suffix=args.vad_suffix)
+    if len(segments) == 0:
+        raise ValueError(f'No speech segments found for calibration in `{args.input_list}`.')
+    logger.info(f'Calibrating on {len(segments)} segments.')
+
+    input_name = onnxruntime.InferenceSession(onnx_path).get_inputs()[0].name
+    with tempfile.NamedTemporaryFile(suffix='.onnx') as preprocessed:
+        # weights of the exported nnet are stored as Constant nodes, fold them into initializers for the quantizer
+        # calibration segments have different lengths, so the nnet must have dynamic axes
+        quant_pre_process(load_onnx(onnx_path), preprocessed.name, skip_symbolic_shape=True)
+        model = onnx.load(preprocessed.name)
+        if model.opset_import[0].version < QDQ_OPSET:
+            onnx.save(version_converter.convert_version(model, QDQ_OPSET), preprocessed.name)
+        # signed INT8 activations and weights, ORT fuses QDQ pairs into VNNI kernels on x64,
+        # while QOperator with signed activations falls back to kernels slower than FP32
+        with atomic_path(out_onnx_path) as tmp_path:
+            quantize_static(preprocessed.name, tmp_path, SegmentsCalibrationDataReader(input_name, segments),
+                            quant_format=QuantFormat.QDQ, op_types_to_quantize=['MatMul', 'Conv', 'Gemm'],
+                            per_channel=True, reduce_range=False,
+                            activation_type=QuantType.QInt8, weight_type=QuantType.QInt8)
+            # ONNXXVectorExtraction loads quantized nnet only if it was made from the current nnet
+            onnx.save(set_source_hash(onnx.load(tmp_path), get_file_hash(onnx_path)), tmp_path)
+    logger.info(f'Quantized nnet stored in `{out_onnx_path}`.')
@@ -2,11 +2,20 @@
 import json
 import logging
 import os
+import re
 
+import numpy as np
 from flask import Flask, request, send_from_directory, Response
 from flask_autoindex import AutoIndex
 from tinytag import TinyTag
 
+from examples.diarization import process_files
+from vbdiar.kaldi.onnx_xvector_extraction import ONNXXVectorExtraction
+from vbdiar.kaldi.python_mfcc_features_extraction import PythonMFCCFeatureExtraction
+from vbdiar.scoring.diarization import Diarization
+from vbdiar.scoring.gplda import GPLDA
+from vbdiar.utils.utils import Utils
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
@@ -19,9 +28,46 @@ UPLOAD_PATH = os.path.join(app_path, UPLOAD_FOLDER)
 
 os.makedirs(UPLOAD_PATH, exist_ok=True)
 app.config['UPLOAD_FOLDER'] = UPLOAD_PATH
+# let front-end server (nginx, apache) send static rttm files by sendfile(2), flask only sets X-Sendfile header,
+# so it must not be enabled when serving directly by gevent/werkzeug
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', '0') == '1'
+
+CONFIG_PATH = '../configs/vbdiar.yml'
+MIN_WINDOW_SIZE = 1000
+MAX_WINDOW_SIZE = 2000
+MAX_NUM_SPEAKERS = 10
+# start, duration and speaker index from lines `SPEAKER <name> 1 <start> <duration> <NA> <NA> <name>_spkr_<idx> <NA>`
+RTTM_PATTERN = re.compile(r'^SPEAKER \S+ \S+ (\S+) (\S+) \S+ \S+ \S*?(\d+) \S+$', re.M)
 
 num_speakers = 4
 
+
+def init_diarization(config_path):
+    """ Load models once, so they are shared by all requests.
+
+    Args:
+        config_path (str): path to configuration of models
+
+    Returns:
+        dict: initialized extractors and transformations
+    """
+    config = Utils.read_config(config_path)
+    config_transforms = config['Transforms']
+    mean, lda = config_transforms.get('mean'), config_transforms.get('lda')
+    plda = config.get('PLDA')
+    return dict(
+        features_extractor=PythonMFCCFeatureExtraction(),
+        embedding_extractor=ONNXXVectorExtraction(
+            onnx_path=os.path.abspath(config['EmbeddingExtractor']['onnx_path'])),
+        mean=np.load(mean) if mean is not None else None,
+        lda=np.load(lda) if lda is not None else None,
+        use_l2_norm=config_transforms.get('use_l2_norm'),
+        plda=GPLDA(plda['path']) if plda is not None else None)
+
+
+app.extensions['diar'] = init_diarization(CONFIG_PATH)
+
+
 def vad(task_path, uploaded_files_name, vad_path):
     tag = TinyTag.get(os.path.join(task_path, uploaded_files_name))
     os.makedirs(vad_path, exist_ok=True)
@@ -39,17 +85,16 @@ def diarization_task(task_path, task_id, uploaded_files_name, num_speakers):
     vad(task_path, uploaded_files_name, vad_path)
     list_filepath = 'lists/{}'.format(os.path.splitext(uploaded_files_name)[0])
     create_list_scp(list_filepath, uploaded_files_name, num_speakers)
-    myCmd = '''python diarization.py -c ../configs/vbdiar.yml \
-    -l {} \
-    --audio-dir {} \
-    --vad-dir {} \
-    --mode diarization \
-    --out-emb-dir embeddings \
-    -vad-suffix .txt \
-    --out-rttm-dir rttm'''.format(list_filepath, task_path, vad_path)
-    logger.info(myCmd)
-    out = os.popen(myCmd).read()
-    logger.info(out)
+    diar_ext = app.extensions['diar']
+    embedding_sets = process_files(
+        fns=['{} {}'.format(os.path.splitext(uploaded_files_name)[0], num_speakers)], wav_dir=task_path,
+        vad_dir=vad_path, out_dir='embeddings', features_extractor=diar_ext['features_extractor'],
+        embedding_extractor=diar_ext['embedding_extractor'], min_size=MIN_WINDOW_SIZE, max_size=MAX_WINDOW_SIZE,
+        overlap=0, tolerance=0, vad_suffix='.txt')
+    diar = Diarization(list_filepath, embedding_sets, embeddings_mean=diar_ext['mean'], lda=diar_ext['lda'],
+                       use_l2_norm=diar_ext['use_l2_norm'], plda=diar_ext['plda'])
+    result = diar.score_embeddings(MIN_WINDOW_SIZE, MAX_NUM_SPEAKERS, 'diarization')
+    diar.dump_rttm(result, 'rttm')
 
 
 def callback(arg):
@@ -61,18 +106,8 @@ def error_callback(arg):
     logger.error(arg)
 
 def rttm2json(rttm):
-    Json = []
-    for line in rttm.split('\n'):
-        if not line == '':
-            result = line.split(' ')
-            temp = {
-                'start': float(result[3]),
-                'end': round(float(result[3]) + float(result[4]), 3),
-                'who': int(result[-2][-1])
-            }
-            Json.append(temp)
-
-    return json.dumps(Json)
+    return json.dumps([{'start': float(start), 'end': round(float(start) + float(dur), 3), 'who': int(who)}
+                       for start, dur, who in RTTM_PATTERN.findall(rttm)])
 
 
 @app.route('/rttm/<path:path>', methods=['GET'])
@@ -5,6 +5,7 @@
 # Author: Jan Profant <jan.profant@phonexia.com>
 # All Rights Reserved
 
+import json
 import os
 import pickle
 import numpy as np
@@ -128,14 +129,46 @@ class EmbeddingSet(object):
         self.embeddings.insert(ii, embedding)
 
     def save(self, path):
-        """ Save embedding set as pickled file.
+        """ Save embedding set as directory with embeddings and windows in .npy files and name and number
+        of speakers in `meta.json`. Features are not saved.
 
         Args:
-            path (string_types): output path
+            path (string_types): output directory
         """
-        mkdir_p(os.path.dirname(path))
-        with open(path, 'wb') as f:
-            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+        mkdir_p(path)
+        np.save(os.path.join(path, 'embeddings.npy'), np.array([e.data.flatten() for e in self.embeddings]))
+        np.save(os.path.join(path, 'windows.npy'),
+                np.array([(e.window_start, e.window_end) for e in self.embeddings], dtype=np.int64).reshape(-1, 2))
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'name': self.name, 'num_speakers': self.num_speakers}, f)
+
+    @classmethod
+    def load(cls, path):
+        """ Load embedding set saved by `save`. Embedding set pickled to `<path>.pkl` by older versions
+        is loaded if the directory does not exist.
+
+        Args:
+            path (string_types): input directory
+
+        Returns:
+            EmbeddingSet: loaded embedding set
+        """
+        if not os.path.isdir(path):
+            with open(f'{path}.pkl', 'rb') as f:
+                return pickle.load(f)
+        embedding_set = cls()
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        embedding_set.name, embedding_set.num_speakers = meta['name'], meta['num_speakers']
+        # not memory mapped, all sets of the list are loaded at once and each map would hold a file descriptor
+        data = np.load(os.path.join(path, 'embeddings.npy'))
+        windows = np.load(os.path.join(path, 'windows.npy'))
+        # embeddings were saved sorted by the start of the window
+        for embedding_data, (window_start, window_end) in zip(data, windows.tolist()):
+            embedding = Embedding()
+            embedding.data, embedding.window_start, embedding.window_end = embedding_data, window_start, window_end
+            embedding_set.embeddings.append(embedding)
+        return embedding_set
 
 
 if __name__ == "__main__":
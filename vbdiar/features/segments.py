@@ -59,6 +59,21 @@ def get_segments(vad, max_size, tolerance):
     return segments
 
 
+def get_segments_array(vad, max_size, tolerance):
+    """ Return clustered speech segments as array.
+
+        :param vad: list with labels - voice activity detection
+        :type vad: list
+        :param max_size: maximal size of window in ms
+        :type max_size: int
+        :param tolerance: accept given number of frames as speech even when it is marked as silence
+        :type tolerance: int
+        :returns: clustered segments with start frame in the first column and end frame in the second one
+        :rtype: np.array
+    """
+    return np.array(get_segments(vad, max_size, tolerance), dtype=int).reshape(-1, 2)
+
+
 def split_segment(segment, max_size):
     """ Split segment to more with adaptive size.
 
@@ -112,6 +127,37 @@ def get_time_from_frames(n):
     return int(n * (TARGETRATE / 10000) - (TARGETRATE / 10000) + (WINDOWSIZE / 10000))
 
 
+def get_frames_from_times(n):
+    """ Get number of frames from ms, vectorized version of `get_frames_from_time`.
+
+        :param n: numbers of ms
+        :type n: np.array
+        :returns: numbers of frames
+        :rtype: np.array
+
+        >>> get_frames_from_times(np.array([0, 25, 35]))
+        array([0, 1, 2])
+    """
+    n = np.asarray(n)
+    assert np.all(n >= 0), 'Time must be at least equal to 0.'
+    frames = (1 + (n - WINDOWSIZE / 10000) / (TARGETRATE / 10000)).astype(int)
+    return np.where(n < 25, 0, frames)
+
+
+def get_times_from_frames(n):
+    """ Get count of ms from number of frames, vectorized version of `get_time_from_frames`.
+
+        :param n: numbers of frames
+        :type n: np.array
+        :returns: numbers of ms
+        :rtype: np.array
+
+        >>> get_times_from_frames(np.array([1, 2]))
+        array([25, 35])
+    """
+    return (np.asarray(n) * (TARGETRATE / 10000) - (TARGETRATE / 10000) + (WINDOWSIZE / 10000)).astype(int)
+
+
 def get_clusters(vad, tolerance=10):
     """ Cluster speech segments.
 
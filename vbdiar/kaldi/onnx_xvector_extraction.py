@@ -5,32 +5,200 @@
 # Author: Jan Profant <xprofa00@stud.fit.vutbr.cz>
 # All Rights Reserved
 
+import hashlib
 import logging
 import os
 
 import numpy as np
+import onnx
 import onnxruntime
 
+from vbdiar.utils import atomic_path
+
 
 logger = logging.getLogger(__name__)
 
 MIN_SIGNAL_LEN = 25
+MAX_BATCH_SIZE = 64
+# metadata of derived nnets (quantized, optimized) identifying content of the nnet they were made from
+SOURCE_HASH_KEY = 'vbdiar_source_sha1'
+
+
+def get_quantized_path(onnx_path):
+    """ Get path to INT8 quantized version of the neural net, see examples/quantize_onnx.py.
+
+    Args:
+        onnx_path (str): path to neural net in ONNX format
+
+    Returns:
+        str: path in format `<name>.int8.onnx`
+    """
+    root, ext = os.path.splitext(onnx_path)
+    return f'{root}.int8{ext}'
+
+
+def get_optimized_path(onnx_path):
+    """ Get path to neural net with graph optimizations already applied by ONNX Runtime.
+
+    Args:
+        onnx_path (str): path to neural net in ONNX format
+
+    Returns:
+        str: path in format `<name>.opt.onnx`
+    """
+    root, ext = os.path.splitext(onnx_path)
+    return f'{root}.opt{ext}'
+
+
+def set_dynamic_axes(model):
+    """ Replace fixed batch and time dimensions of x-vector nnet by symbolic ones.
+
+    Nnet exported from Kaldi declares input of shape [1, num_coefs, num_frames] with dimensions fixed to the
+    values used for export, so ONNX Runtime refuses segments of different length and batches of segments.
+
+    Args:
+        model (onnx.ModelProto): x-vector nnet
+
+    Returns:
+        onnx.ModelProto: x-vector nnet with dynamic axes
+    """
+    dims = model.graph.input[0].type.tensor_type.shape.dim
+    dims[0].dim_param = 'batch'
+    dims[2].dim_param = 'frames'
+    model.graph.output[0].type.tensor_type.shape.dim[0].dim_param = 'batch'
+    return model
+
+
+def load_onnx(onnx_path):
+    """ Load x-vector nnet with dynamic batch and time axes, the file itself is not modified.
+
+    Args:
+        onnx_path (str): path to neural net in ONNX format
+
+    Returns:
+        onnx.ModelProto: x-vector nnet with dynamic axes
+    """
+    return set_dynamic_axes(onnx.load(onnx_path))
+
+
+def get_file_hash(path):
+    """ Compute SHA-1 hash of file content.
+
+    Args:
+        path (str): path to file
+
+    Returns:
+        str: hex digest
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def set_source_hash(model, source_hash):
+    """ Record hash of the nnet which the derived nnet was made from in its metadata.
+
+    Args:
+        model (onnx.ModelProto): derived nnet
+        source_hash (str): hash of source nnet, see `get_file_hash`
+
+    Returns:
+        onnx.ModelProto: derived nnet
+    """
+    for prop in model.metadata_props:
+        if prop.key == SOURCE_HASH_KEY:
+            prop.value = source_hash
+            return model
+    model.metadata_props.add(key=SOURCE_HASH_KEY, value=source_hash)
+    return model
+
+
+def is_derived_from(path, source_hash):
+    """ Check if derived nnet exists and was made from the source nnet with given hash. Modification times
+    are not reliable, copying with `cp -p`, `rsync -a` or tar keeps them.
+
+    Args:
+        path (str): path to derived nnet
+        source_hash (str): hash of source nnet, see `get_file_hash`
+
+    Returns:
+        bool: derived nnet is up to date
+    """
+    if not os.path.isfile(path):
+        return False
+    props = {prop.key: prop.value for prop in onnx.load(path, load_external_data=False).metadata_props}
+    return props.get(SOURCE_HASH_KEY) == source_hash
+
+
+def optimize_onnx(onnx_path, optimized_path):
+    """ Apply graph optimizations of ONNX Runtime (constant folding, Conv+BatchNorm and Conv+Relu fusions, ...)
+    and store the optimized neural net, so they are not repeated for every session.
+
+    Layout optimizations of ORT_ENABLE_ALL are hardware specific, they are not stored and are applied when loading.
+
+    Args:
+        onnx_path (str): path to neural net in ONNX format
+        optimized_path (str): output path of optimized neural net
+    """
+    # ONNX Runtime writes the file in place, parallel jobs must never load partially written file
+    with atomic_path(optimized_path) as tmp_path:
+        sess_options = onnxruntime.SessionOptions()
+        sess_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+        sess_options.optimized_model_filepath = tmp_path
+        onnxruntime.InferenceSession(load_onnx(onnx_path).SerializeToString(), sess_options)
+        onnx.save(set_source_hash(onnx.load(tmp_path), get_file_hash(onnx_path)), tmp_path)
 
 
 class ONNXXVectorExtraction(object):
 
-    def __init__(self, onnx_path):
+    def __init__(self, onnx_path, use_quantized=True, num_threads=None):
         """ Initialize ONNX x-vector extractor.
 
         Args:
             onnx_path (str): path to neural net in ONNX format, see https://github.com/onnx/onnx
+            use_quantized (bool): load INT8 quantized net stored next to `onnx_path` if it was made from it
+            num_threads (int|None): number of intra-op threads, ONNX Runtime uses all physical cores by default
+                (divide them by number of jobs when running in multiprocessing pool)
         """
         if not os.path.isfile(onnx_path):
             raise ValueError(f'Invalid path to nnet `{onnx_path}`.')
         else:
+            quantized_path = get_quantized_path(onnx_path)
+            if use_quantized and os.path.isfile(quantized_path):
+                if is_derived_from(quantized_path, get_file_hash(onnx_path)):
+                    logger.info(f'Using quantized nnet `{quantized_path}`.')
+                    onnx_path = quantized_path
+                else:
+                    logger.warning(f'Quantized nnet `{quantized_path}` was not made from `{onnx_path}`, '
+                                   f'it is ignored, run examples/quantize_onnx.py again.')
             self.onnx_path = onnx_path
-            self.sess = onnxruntime.InferenceSession(onnx_path)
+
+            sess_options = onnxruntime.SessionOptions()
+            sess_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            sess_options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+            if num_threads is not None:
+                sess_options.intra_op_num_threads = num_threads
+            sess_options.enable_cpu_mem_arena = True
+            # do not busy-wait for work between runs, it steals cores from the other jobs
+            sess_options.add_session_config_entry('session.intra_op.allow_spinning', '0')
+
+            # graph optimizations are done only once, optimized graph is stored next to the original one,
+            # it can be also prepared in advance by examples/optimize_onnx.py
+            optimized_path = get_optimized_path(onnx_path)
+            onnx_hash = get_file_hash(onnx_path)
+            if not is_derived_from(optimized_path, onnx_hash) and os.access(
+                    os.path.dirname(os.path.abspath(optimized_path)), os.W_OK):
+                logger.info(f'Storing optimized nnet to `{optimized_path}`.')
+                optimize_onnx(onnx_path, optimized_path)
+            if is_derived_from(optimized_path, onnx_hash):
+                logger.info(f'Using optimized nnet `{optimized_path}`.')
+                onnx_path = optimized_path
+            # axes are made dynamic in memory, so segments of any length can be batched with the nnet as shipped
+            self.sess = onnxruntime.InferenceSession(load_onnx(onnx_path).SerializeToString(), sess_options)
             self.input_name = self.sess.get_inputs()[0].name
+            self.batch_size = MAX_BATCH_SIZE
 
     def features2embeddings(self, data_dict):
         """ Extract x-vector embeddings from feature vectors.
@@ -42,7 +210,9 @@ class ONNXXVectorExtraction(object):
 
         """
         logger.info(f'Extracting x-vectors from {len(data_dict)} segments.')
-        xvec_dict = {}
+        # statistics pooling in the nnet is not masked, padding would change the embeddings,
+        # so only segments of the same length are batched together
+        names_by_len = {}
         for name in data_dict:
             signal_len, num_coefs = data_dict[name].shape
             # here we need to avoid failing on very short inputs, so we will just concatenate frames in time
@@ -51,6 +221,14 @@ class ONNXXVectorExtraction(object):
             elif signal_len < MIN_SIGNAL_LEN:
                 for i in range(MIN_SIGNAL_LEN // signal_len):
                     data_dict[name] = np.concatenate((data_dict[name], data_dict[name]), axis=0)
-            xvec = self.sess.run(None, {self.input_name: data_dict[name].T[np.newaxis, :, :]})[0]
-            xvec_dict[name] = xvec.squeeze()
+            names_by_len.setdefault(data_dict[name].shape[0], []).append(name)
+
+        xvec_dict = {}
+        for names in names_by_len.values():
+            for start in range(0, len(names), self.batch_size):
+                batch_names = names[start:start + self.batch_size]
+                batch = np.stack([data_dict[name].T for name in batch_names])
+                xvecs = self.sess.run(None, {self.input_name: batch})[0]
+                for name, xvec in zip(batch_names, xvecs):
+                    xvec_dict[name] = xvec.squeeze()
         return xvec_dict
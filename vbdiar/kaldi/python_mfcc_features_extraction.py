@@ -1,20 +1,298 @@
 # -*- coding: utf-8 -*-
+import functools
+import hashlib
+import os
+import pickle
+import struct
+import tempfile
+import threading
+
 import numpy as np
-import speechpy
+from scipy.fftpack import dct
 from scipy.io import wavfile
 
-from python_speech_features import mfcc
+try:
+    import pyfftw
+except ImportError:
+    pyfftw = None
+
+from python_speech_features import get_filterbanks, lifter
+from vbdiar.utils import atomic_path, mkdir_p
+
+
+SAMPLE_RATE = 16000
+FRAME_LENGTH = 400  # 25ms
+FRAME_SHIFT = 160  # 10ms
+NFFT = 512
+NUM_FILTERS = 23
+NUM_CEPS = 23
+LOW_FREQ = 20
+HIGH_FREQ = 7700
+PREEMPH = 0.97
+CEP_LIFTER = 22
+CMVN_WINDOW = 301
+# number of frames transformed at once, bounds the size of intermediate spectra
+BLOCK_SIZE = 4096
+EPS = np.finfo(float).eps
+# number of frames transformed by single FFTW plan, tail of each block is transformed by numpy
+FFTW_BLOCK_SIZE = 256
+# FFTW plans measured once are reused by following runs
+FFTW_WISDOM_PATH = os.path.expanduser('~/.pyfftw_wisdom')
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+# sample types of wav formats which are memory mapped, keyed by format and bits per sample
+WAVE_DTYPES = {
+    (WAVE_FORMAT_PCM, 8): np.dtype('u1'),
+    (WAVE_FORMAT_PCM, 16): np.dtype('<i2'),
+    (WAVE_FORMAT_PCM, 32): np.dtype('<i4'),
+    (WAVE_FORMAT_IEEE_FLOAT, 32): np.dtype('<f4'),
+    (WAVE_FORMAT_IEEE_FLOAT, 64): np.dtype('<f8'),
+}
+# identifies features computed with current configuration in cache
+CONFIG_HASH = hashlib.sha1(repr((
+    SAMPLE_RATE, FRAME_LENGTH, FRAME_SHIFT, NFFT, NUM_FILTERS, NUM_CEPS, LOW_FREQ, HIGH_FREQ, PREEMPH, CEP_LIFTER,
+    CMVN_WINDOW)).encode()).hexdigest()
+
+
+def read_wav(input_path):
+    """ Read mono PCM or IEEE float wav file as read-only memory map of its data chunk, so the signal
+    is not copied when loading and frames are views into the page cache. Other formats are read by scipy.
+
+    Args:
+        input_path (string_types): audio file path
+
+    Returns:
+        Tuple[int, np.array]: sample rate and signal
+    """
+    fmt, data_offset, data_size = None, None, None
+    with open(input_path, 'rb') as f:
+        riff, _, wave = struct.unpack('<4sI4s', f.read(12))
+        if riff == b'RIFF' and wave == b'WAVE':
+            while True:
+                chunk_header = f.read(8)
+                if len(chunk_header) < 8:
+                    break
+                chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+                if chunk_id == b'fmt ':
+                    fmt = struct.unpack('<HHIIHH', f.read(16))
+                    chunk_size -= 16
+                elif chunk_id == b'data':
+                    data_offset, data_size = f.tell(), chunk_size
+                    break
+                # chunks are word aligned
+                f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+    if fmt is not None and data_offset is not None:
+        audio_format, num_channels, rate, _, _, bits_per_sample = fmt
+        dtype = WAVE_DTYPES.get((audio_format, bits_per_sample))
+        if dtype is not None and num_channels == 1:
+            # size of data chunk is not reliable in streamed wav files
+            num_samples = min(data_size, os.path.getsize(input_path) - data_offset) // dtype.itemsize
+            if num_samples > 0:
+                return rate, np.memmap(input_path, dtype=dtype, mode='r', offset=data_offset, shape=(num_samples,))
+    return wavfile.read(input_path)
+
+
+def povey_window(frame_length):
+    """ Povey window as defined in Kaldi (kaldi/src/feat/feature-window.h).
+
+    Args:
+        frame_length (int): length of the window in samples
+
+    Returns:
+        np.array: window
+    """
+    return (0.5 - 0.5 * np.cos(2 * np.pi / (frame_length - 1) * np.arange(frame_length))) ** 0.85
+
+
+def frame_signal(signal, frame_length, frame_shift):
+    """ Split signal into overlapping frames without copying the data.
+
+    Args:
+        signal (np.array): input 1-D signal
+        frame_length (int): length of the frame in samples
+        frame_shift (int): shift between frames in samples
+
+    Returns:
+        np.array: read-only view of shape (num_frames, frame_length)
+    """
+    if len(signal) < frame_length:
+        signal = np.pad(signal, (0, frame_length - len(signal)))
+    num_frames = 1 + (len(signal) - frame_length) // frame_shift
+    stride = signal.strides[0]
+    return np.lib.stride_tricks.as_strided(
+        signal, shape=(num_frames, frame_length), strides=(frame_shift * stride, stride), writeable=False)
+
+
+def sliding_cmn(features, win_size):
+    """ Sliding window cepstral mean normalization, equivalent to
+    `speechpy.processing.cmvnw(features, win_size, variance_normalization=False)`.
+
+    Window means are computed as differences of cumulative sums, so the cost does not depend on `win_size`.
+
+    Args:
+        features (np.array): input features of shape (num_frames, num_coefs)
+        win_size (int): odd size of the sliding window in frames
+
+    Returns:
+        np.array: normalized features of shape (num_frames, num_coefs)
+    """
+    if win_size % 2 != 1:
+        raise ValueError(f'Size of the window must be odd, got {win_size}.')
+    pad_size = win_size // 2
+    padded = np.pad(features, ((pad_size, pad_size), (0, 0)), mode='symmetric')
+    csum = np.zeros((padded.shape[0] + 1, padded.shape[1]))
+    np.cumsum(padded, axis=0, dtype=np.float64, out=csum[1:])
+    return features - (csum[win_size:] - csum[:-win_size]) / win_size
+
+
+# constant for given configuration, computed once at import
+_WINDOW = povey_window(FRAME_LENGTH)
+# filters in columns, so the filterbank energies are just `power @ _MEL`
+_MEL = get_filterbanks(NUM_FILTERS, NFFT, SAMPLE_RATE, LOW_FREQ, HIGH_FREQ).T
+# orthonormal DCT-II with lifter folded in, cepstra are just `log_fbank @ _DCT`
+_DCT = lifter(dct(np.eye(NUM_FILTERS), type=2, axis=0, norm='ortho')[:NUM_CEPS].T, CEP_LIFTER)
+
+
+def plan_rfft():
+    """ Plan FFTW real FFT of `FFTW_BLOCK_SIZE` frames into aligned buffers. FFTW wisdom is loaded from
+    `FFTW_WISDOM_PATH` and stored there if the file does not exist yet.
+
+    Returns:
+        pyfftw.FFTW: planned FFT
+    """
+    try:
+        with open(FFTW_WISDOM_PATH, 'rb') as f:
+            pyfftw.import_wisdom(pickle.load(f))
+        has_wisdom = True
+    except (OSError, pickle.UnpicklingError, EOFError, TypeError):
+        has_wisdom = False
+    # double precision keeps the features equal to the ones computed by numpy
+    in_buf = pyfftw.empty_aligned((FFTW_BLOCK_SIZE, NFFT), dtype=np.float64)
+    out_buf = pyfftw.empty_aligned((FFTW_BLOCK_SIZE, NFFT // 2 + 1), dtype=np.complex128)
+    plan = pyfftw.FFTW(in_buf, out_buf, axes=(1,), flags=('FFTW_MEASURE',), threads=1)
+    # planning overwrites the input, samples behind the frame must stay zero
+    in_buf[:] = 0
+    if not has_wisdom:
+        try:
+            with tempfile.NamedTemporaryFile(
+                    dir=os.path.dirname(FFTW_WISDOM_PATH), prefix='.pyfftw_wisdom', delete=False) as f:
+                pickle.dump(pyfftw.export_wisdom(), f)
+            os.replace(f.name, FFTW_WISDOM_PATH)
+        except OSError:
+            pass
+    return plan
+
+
+# plans are created on first use, each thread has its own, since they own their buffers
+_rfft_plans = threading.local()
+
+
+def power_spectrum(frames):
+    """ Compute power spectrum of windowed frames. If pyfftw is installed, full blocks of `FFTW_BLOCK_SIZE`
+    frames are transformed by planned FFTW, the rest by numpy.
+
+    Args:
+        frames (np.array): frames of shape (num_frames, FRAME_LENGTH)
+
+    Returns:
+        np.array: power spectrum of shape (num_frames, NFFT // 2 + 1)
+    """
+    num_frames = frames.shape[0]
+    num_fftw_frames = 0 if pyfftw is None else num_frames - num_frames % FFTW_BLOCK_SIZE
+    power = np.empty((num_frames, NFFT // 2 + 1))
+    if num_fftw_frames > 0:
+        plan = getattr(_rfft_plans, 'plan', None)
+        if plan is None:
+            plan = _rfft_plans.plan = plan_rfft()
+        for start in range(0, num_fftw_frames, FFTW_BLOCK_SIZE):
+            end = start + FFTW_BLOCK_SIZE
+            np.multiply(frames[start:end], _WINDOW, out=plan.input_array[:, :FRAME_LENGTH])
+            plan.execute()
+            np.square(plan.output_array.real, out=power[start:end])
+            power[start:end] += np.square(plan.output_array.imag)
+    if num_fftw_frames < num_frames:
+        spectrum = np.fft.rfft(frames[num_fftw_frames:] * _WINDOW, NFFT)
+        power[num_fftw_frames:] = np.square(spectrum.real) + np.square(spectrum.imag)
+    return power
+
+
+def cache_features(audio2features):
+    """ Cache features on disk in `self.cache_dir`, so another pass over the same audio file (e.g. normalization)
+    only memory maps them. Cache key is made of path, modification time and size of the audio file and
+    of the configuration of features.
+
+    Args:
+        audio2features (Callable): method extracting features from audio file path
+
+    Returns:
+        Callable: cached method
+    """
+    @functools.wraps(audio2features)
+    def wrapper(self, input_path):
+        if self.cache_dir is None:
+            return audio2features(self, input_path)
+        stat = os.stat(input_path)
+        key = hashlib.sha1(
+            f'{os.path.abspath(input_path)}:{stat.st_mtime_ns}:{stat.st_size}:{CONFIG_HASH}'.encode()).hexdigest()
+        cache_path = os.path.join(self.cache_dir, f'{key}.npy')
+        if os.path.isfile(cache_path):
+            return np.load(cache_path, mmap_mode='r')
+        features = audio2features(self, input_path)
+        mkdir_p(self.cache_dir)
+        # parallel jobs must never load partially written file
+        with atomic_path(cache_path) as tmp_path, open(tmp_path, 'wb') as f:
+            np.save(f, features)
+        return features
+    return wrapper
 
 
 class PythonMFCCFeatureExtraction():
-    def __init__(self):
-        pass
+    def __init__(self, cache_dir=None):
+        """ Initialize Python MFCC extraction component.
+
+        Args:
+            cache_dir (string_types|None): directory for caching extracted features, caching is disabled if None
+        """
+        self.cache_dir = cache_dir
+
+    def mfcc(self, signal, num_pad_frames=0):
+        """ Compute MFCC features, equivalent to python_speech_features call
+        `mfcc(signal, dither=0, highfreq=7700, useEnergy=True, wintype='povey', numcep=23)`.
+
+        Frames are processed in blocks of `BLOCK_SIZE` without any per-frame python loop.
+
+        Args:
+            signal (np.array): input 1-D signal
+            num_pad_frames (int): number of copies of the last frame appended to the output
+
+        Returns:
+            np.array: features of shape (num_frames + num_pad_frames, NUM_CEPS)
+        """
+        # signal may be read-only memory map, all in-place operations are done on copies of blocks
+        frames = frame_signal(signal, FRAME_LENGTH, FRAME_SHIFT)
+        num_frames = frames.shape[0]
+        features = np.empty((num_frames + num_pad_frames, NUM_CEPS))
+        for start in range(0, num_frames, BLOCK_SIZE):
+            end = min(start + BLOCK_SIZE, num_frames)
+            block = frames[start:end].astype(np.float32)
+            # remove dc offset
+            block -= block.mean(axis=1, keepdims=True)
+            energy = np.square(block, dtype=np.float64).sum(axis=1)
+            # preemphasis, column 0 must be scaled last, since column 1 depends on its original value
+            block[:, 1:] -= PREEMPH * block[:, :-1]
+            block[:, 0] *= 1 - PREEMPH
+            fbank = np.maximum(power_spectrum(block) @ _MEL, EPS)
+            features[start:end] = np.log(fbank) @ _DCT
+            # replace first cepstral coefficient with log of frame energy
+            features[start:end, 0] = np.log(np.maximum(energy, EPS))
+        features[num_frames:] = features[num_frames - 1]
+        return features
 
+    @cache_features
     def audio2features(self, input_path):
-        (rate, sig) = wavfile.read(input_path)
-        mfcc_feat = mfcc(sig, dither=0, highfreq=7700, useEnergy=True, wintype='povey', numcep=23)
+        (rate, sig) = read_wav(input_path)
         # TODO temporarily add 2 feats to meet Kaldi_mfcc_features_extraction API
-        mfcc_feat = np.append(mfcc_feat, [mfcc_feat[-1]], axis=0)
-        mfcc_feat = np.append(mfcc_feat, [mfcc_feat[-1]], axis=0)
-        mfcc_cmvn = speechpy.processing.cmvnw(mfcc_feat, win_size=301, variance_normalization=False)
-        return mfcc_cmvn.astype(np.float32)
+        mfcc_feat = self.mfcc(sig, num_pad_frames=2)
+        mfcc_cmvn = sliding_cmn(mfcc_feat, win_size=CMVN_WINDOW)
+        # nnet input is float32, ONNX Runtime would cast every segment otherwise
+        return np.ascontiguousarray(mfcc_cmvn, dtype=np.float32)
@@ -7,7 +7,6 @@
 
 import os
 import re
-import pickle
 import logging
 from shutil import rmtree
 from subprocess import check_output
@@ -21,6 +20,7 @@ from sklearn.cluster import AgglomerativeClustering, DBSCAN, MeanShift
 from sklearn.metrics.pairwise import cosine_similarity, pairwise_distances
 
 from vbdiar.clustering.pldakmeans import PLDAKMeans
+from vbdiar.embeddings.embedding import EmbeddingSet
 from vbdiar.scoring.normalization import Normalization
 from vbdiar.utils import mkdir_p
 from vbdiar.utils.utils import Utils
@@ -147,32 +147,30 @@ class Diarization(object):
         raise ValueError(f'Name of the set not found - `{name}`.')
 
     def load_embeddings(self):
-        """ Load embedding from pickled files.
+        """ Load embedding sets saved by `EmbeddingSet.save`.
 
         Returns:
             List[EmbeddingSet]:
         """
-        logger.info(f'Loading pickled evaluation embedding from `{self.embeddings_dir}`.')
+        logger.info(f'Loading evaluation embedding from `{self.embeddings_dir}`.')
         with open(self.input_list, 'r') as f:
             for line in f:
                 if len(line) > 0:
-                    logger.info(f'Loading evaluation pickle file `{line.rstrip().split()[0]}`.')
+                    logger.info(f'Loading evaluation embedding set `{line.rstrip().split()[0]}`.')
                     line = line.rstrip()
                     try:
                         if len(line.split()) == 1:
-                            with open(os.path.join(self.embeddings_dir, line + '.pkl'), 'rb') as i:
-                                yield pickle.load(i)
+                            yield EmbeddingSet.load(os.path.join(self.embeddings_dir, line))
                         elif len(line.split()) == 2:
                             file_name = line.split()[0]
                             num_spks = int(line.split()[1])
-                            with open(os.path.join(self.embeddings_dir, file_name + '.pkl'), 'rb') as i:
-                                ivec_set = pickle.load(i)
-                                ivec_set.num_speakers = num_spks
-                                yield ivec_set
+                            ivec_set = EmbeddingSet.load(os.path.join(self.embeddings_dir, file_name))
+                            ivec_set.num_speakers = num_spks
+                            yield ivec_set
                         else:
                             raise ValueError(f'Unexpected number of columns in input list `{self.input_list}`.')
                     except IOError:
-                        logger.warning(f'No pickle file found for `{line.rstrip().split()[0]}`'
+                        logger.warning(f'No embedding set found for `{line.rstrip().split()[0]}`'
                                        f' in `{self.embeddings_dir}`.')
 
     def score_embeddings(self, min_length, max_num_speakers, mode):
@@ -203,10 +203,9 @@ class Normalization(object):
 
         if self.out_emb_dir:
             for speaker in merged_speakers_dict:
-                out_path = os.path.join(self.out_emb_dir, f'{speaker}.pkl')
+                out_path = os.path.join(self.out_emb_dir, f'{speaker}.npy')
                 mkdir_p(os.path.dirname(out_path))
-                with open(out_path, 'wb') as f:
-                    pickle.dump(merged_speakers_dict[speaker], f, pickle.HIGHEST_PROTOCOL)
+                np.save(out_path, np.asarray(merged_speakers_dict[speaker]))
 
         for speaker in merged_speakers_dict:
             merged_speakers_dict[speaker] = np.mean(merged_speakers_dict[speaker], axis=0)
@@ -214,7 +213,7 @@ class Normalization(object):
         return np.array(list(merged_speakers_dict.values()))
 
     def load_embeddings(self):
-        """ Load normalization embeddings from pickle files.
+        """ Load normalization embeddings from .npy files, pickle files of older versions are loaded as fallback.
 
         Returns:
             np.array: embeddings per speaker
@@ -230,17 +229,19 @@ class Normalization(object):
                     for line in fp:
                         speakers.add(line.split()[7])
 
-        logger.info('Loading pickled normalization embeddings from `{}`.'.format(self.in_emb_dir))
+        logger.info('Loading normalization embeddings from `{}`.'.format(self.in_emb_dir))
         for speaker in speakers:
-            embedding_path = os.path.join(self.in_emb_dir, '{}.pkl'.format(speaker))
-            if os.path.isfile(embedding_path):
+            embedding_path = os.path.join(self.in_emb_dir, speaker)
+            if os.path.isfile(f'{embedding_path}.npy'):
+                logger.info('Loading normalization file `{}`.'.format(speaker))
+                # append mean from speaker's embeddings
+                embeddings.append(np.mean(np.load(f'{embedding_path}.npy', mmap_mode='r'), axis=0))
+            elif os.path.isfile(f'{embedding_path}.pkl'):
                 logger.info('Loading normalization pickle file `{}`.'.format(speaker))
-                with open(embedding_path, 'rb') as f:
-                    # append mean from speaker's embeddings
-                    speaker_embeddings = pickle.load(f)
-                    embeddings.append(np.mean(speaker_embeddings, axis=0))
+                with open(f'{embedding_path}.pkl', 'rb') as f:
+                    embeddings.append(np.mean(pickle.load(f), axis=0))
             else:
-                logger.warning('No pickle file found for `{}` in `{}`.'.format(speaker, self.in_emb_dir))
+                logger.warning('No embeddings file found for `{}` in `{}`.'.format(speaker, self.in_emb_dir))
         return np.array(embeddings)
 
     def s_norm(self, test, enroll):
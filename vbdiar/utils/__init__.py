@@ -7,6 +7,8 @@
 
 import os
 import errno
+import uuid
+from contextlib import contextmanager
 
 
 def mkdir_p(path):
@@ -24,4 +26,22 @@ def mkdir_p(path):
             raise ValueError('Can not create directory {}.'.format(path))
 
 
+@contextmanager
+def atomic_path(path):
+    """ Provide temporary path next to `path`, which replaces `path` when the block finishes without error,
+    so parallel readers never load partially written file. Unlike tempfile, the file written to the temporary
+    path gets default permissions given by umask.
 
+    Args:
+        path (string_types): final path of the file
+
+    Yields:
+        string_types: temporary path to write the file to
+    """
+    tmp_path = os.path.join(os.path.dirname(os.path.abspath(path)), f'.{os.path.basename(path)}.{uuid.uuid4().hex}')
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)